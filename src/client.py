@@ -2,12 +2,13 @@
 # -*- coding: utf-8 -*-
 
 from argparse import Namespace
-from collections import deque
-from datetime import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Pool
 
 import logging
+import selectors
 import socket
+import time
 
 from paramparser import ParameterParser
 from util import Util
@@ -36,13 +37,34 @@ def __populate_start_parser(start_parser):
     start_parser.add_argument(
         '-l', '--bufsize', metavar='BS', type=str,
         help='The maximum amount of data to be received at once \
-              (default: 4KB) ([BKMG])',
-        default='4KB')
+              (default: 64KB) ([BKMG])',
+        default='64KB')
     start_parser.add_argument(
         '-c', '--cache', type=str,
         help='Size of cache for keeping the most recent received data \
               (default: 512MB) ([BKMG])',
         default='512MB')
+    start_parser.add_argument(
+        '-R', '--rcvbuf', type=str,
+        help='The size of the socket receive buffer (SO_RCVBUF). Leave it \
+              unset to keep the receive buffer auto-tuning of the kernel \
+              (see tcp(7)) ([BKMG])')
+    start_parser.add_argument(
+        '-B', '--busy-poll', metavar='USEC', type=int,
+        help='Busy poll the device queue for up to this many microseconds \
+              when a read finds the socket with no data (SO_BUSY_POLL). It \
+              trades CPU time for lower latency, and raising it above \
+              net.core.busy_read needs CAP_NET_ADMIN (see socket(7))')
+    start_parser.add_argument(
+        '-i', '--io-backend', type=str,
+        help='How to receive data from multiple servers: "thread" runs one \
+              thread per server, "process" runs one process per server \
+              which suits the methods that are CPU bound, "select" \
+              receives from all the servers in a single thread, waiting \
+              for any of the sockets to be ready for reading \
+              (default: thread)',
+        choices=['thread', 'process', 'select'],
+        default='thread')
 
     start_parser.set_multi_value_dest('method')
     start_parser.add_argument(
@@ -63,12 +85,16 @@ def __handle_start(arg_attrs_ns):
         bind_addr=arg_attrs_ns.bind,
         bufsize=Util.human2bytes(arg_attrs_ns.bufsize),
         cache=Util.human2bytes(arg_attrs_ns.cache),
+        rcvbuf=Util.human2bytes(arg_attrs_ns.rcvbuf)
+        if arg_attrs_ns.rcvbuf else None,
+        busy_poll=arg_attrs_ns.busy_poll,
+        io_backend=arg_attrs_ns.io_backend,
         method=ParameterParser.split_multi_value_param(arg_attrs_ns.method))
 
     __do_start(args_ns)
 
 
-def __setup_socket(addr, port, bind_addr):
+def __setup_socket(addr, port, bind_addr, rcvbuf, busy_poll):
     # Create TCP socket
     try:
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -76,6 +102,37 @@ def __setup_socket(addr, port, bind_addr):
         logger.exception("Could not create socket")
         raise
 
+    if rcvbuf:
+        # Set it before connect() so that the TCP window scale option
+        # negotiated during the handshake can cover the buffer size.
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        except socket.error:
+            logger.exception("Unable to set SO_RCVBUF to %d bytes", rcvbuf)
+            sock.close()
+            sock = None
+            raise
+
+        # The kernel doubles the value and caps it by net.core.rmem_max
+        logger.info("[SO_RCVBUF: %d bytes]",
+                    sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
+
+    if busy_poll is not None:
+        # Linux only busy polls when receiving, so it is set on the client.
+        # The constant is only exposed by the socket module since
+        # Python 3.7.
+        so_busy_poll = getattr(socket, 'SO_BUSY_POLL', 46)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, so_busy_poll, busy_poll)
+        except socket.error:
+            logger.exception(
+                "Unable to set SO_BUSY_POLL to %d microseconds", busy_poll)
+            sock.close()
+            sock = None
+            raise
+
+        logger.info("[SO_BUSY_POLL: %d microseconds]", busy_poll)
+
     logger.info("Connecting to server %s on port %d", addr, port)
 
     if bind_addr:
@@ -109,59 +166,253 @@ def __setup_socket(addr, port, bind_addr):
     return sock
 
 
-def __run(idx, classobj, args_ns, size, mem_limit_bs):
-    sock = __setup_socket(
-        args_ns.host_addrs[idx], args_ns.port, args_ns.bind_addr)
-    iofilter = classobj.create(
-        sock, args_ns.bufsize, extra_args=args_ns.method[1:])
+def __cache(byte_mem, pos, bytes_obj):
+    """Write the bytes to the ring buffer byte_mem starting from pos.
+
+    Returns:
+        int: The position in byte_mem to start the next write from.
+
+    """
+    capacity = len(byte_mem)
+    length = len(bytes_obj)
+
+    if length >= capacity:
+        # Only the most recent bytes fit in the buffer
+        byte_mem[:] = memoryview(bytes_obj)[length - capacity:]
+        return 0
+
+    end = pos + length
+    if end <= capacity:
+        byte_mem[pos:end] = bytes_obj
+        return end % capacity
+
+    first = capacity - pos
+    view = memoryview(bytes_obj)
+    byte_mem[pos:] = view[:first]
+    byte_mem[:length - first] = view[first:]
+    return length - first
+
+
+def __alloc_cache(mem_limit_bs, size):
+    # Preallocate the cache as a ring buffer so keeping the received data
+    # neither allocates nor shifts memory on every read. It must be done
+    # before connecting since the server starts timing on accepting the
+    # connection, and it never needs to be larger than the data to receive.
+    return bytearray(min(mem_limit_bs, size)) if mem_limit_bs else None
+
+
+def __connect(idx, classobj, args_ns, size, mem_limit_bs):
+    """Set up the connection to the server at index idx.
 
-    if mem_limit_bs:
-        byte_mem = deque(maxlen=mem_limit_bs)  # type: typing.Deque[int]
+    Returns:
+        Namespace: The state of receiving data from the server.
 
-    left = size
-    recvd = 0
+    """
+    byte_mem = __alloc_cache(mem_limit_bs, size)
+
+    sock = __setup_socket(
+        args_ns.host_addrs[idx], args_ns.port, args_ns.bind_addr,
+        args_ns.rcvbuf, args_ns.busy_poll)
+    try:
+        iofilter = classobj.create(
+            sock, args_ns.bufsize, extra_args=args_ns.method[1:])
+    except Exception:
+        sock.close()
+        raise
+
+    return Namespace(
+        idx=idx,
+        sock=sock,
+        iofilter=iofilter,
+        left=size,
+        recvd=0,
+        byte_mem=byte_mem,
+        mem_pos=0,
+        t_start=None)
+
+
+def __recv_debug(conn, bufsize):
+    # The slow generic loop, which also logs every read
+    read = conn.iofilter.read
+    byte_mem = conn.byte_mem
+    mem_pos = conn.mem_pos
+    left = conn.left
+    recvd = conn.recvd
 
-    t_start = dt.now().timestamp()
     try:
         while left > 0:
-            num_bys = min(args_ns.bufsize, left)
-            bytes_obj, ctrl_num = iofilter.read(num_bys)
+            bytes_obj, ctrl_num = read(bufsize if left >= bufsize else left)
             if not ctrl_num:
                 break
 
-            if mem_limit_bs:
-                byte_mem.extend(bytes_obj)
+            if byte_mem is not None:
+                mem_pos = __cache(byte_mem, mem_pos, bytes_obj)
 
             byte_length = len(bytes_obj)
             recvd += byte_length
 
             left -= ctrl_num
 
-            if logger.isEnabledFor(logging.DEBUG):
-                bytes_summary = bytes(bytes_obj[:50])
-                logger.debug("Received %d bytes of data (summary %r%s)",
-                             byte_length,
-                             bytes_summary,
-                             '...' if byte_length > len(bytes_summary)
-                             else '')
+            logger.debug("Received %d bytes of data (summary %s)",
+                         byte_length, Util.summarize(bytes_obj))
+    finally:
+        conn.mem_pos, conn.left, conn.recvd = mem_pos, left, recvd
+
+
+def __recv_cached(conn, bufsize):
+    # Bind to local names to save the attribute lookups in the loop
+    read = conn.iofilter.read
+    byte_mem = conn.byte_mem
+    mem_pos = conn.mem_pos
+    left = conn.left
+    recvd = conn.recvd
+
+    try:
+        while left > 0:
+            bytes_obj, ctrl_num = read(bufsize if left >= bufsize else left)
+            if not ctrl_num:
+                break
+            mem_pos = __cache(byte_mem, mem_pos, bytes_obj)
+            recvd += len(bytes_obj)
+            left -= ctrl_num
+    finally:
+        conn.mem_pos, conn.left, conn.recvd = mem_pos, left, recvd
+
+
+def __recv_plain(conn, bufsize):
+    # Bind to local names to save the attribute lookups in the loop
+    read = conn.iofilter.read
+    left = conn.left
+    recvd = conn.recvd
+
+    try:
+        while left > 0:
+            bytes_obj, ctrl_num = read(bufsize if left >= bufsize else left)
+            if not ctrl_num:
+                break
+            recvd += len(bytes_obj)
+            left -= ctrl_num
+    finally:
+        conn.left, conn.recvd = left, recvd
+
+
+def __run(idx, classobj, args_ns, size, mem_limit_bs):
+    conn = __connect(idx, classobj, args_ns, size, mem_limit_bs)
+
+    # Choose the loop once instead of testing the cache and the log
+    # level on every read.
+    if logger.isEnabledFor(logging.DEBUG):
+        recv_loop = __recv_debug
+    elif conn.byte_mem is not None:
+        recv_loop = __recv_cached
+    else:
+        recv_loop = __recv_plain
+
+    # The monotonic clock is not affected by system clock updates and it
+    # is system-wide, so the timestamps are comparable across processes.
+    t_start = time.monotonic()
+    try:
+        recv_loop(conn, args_ns.bufsize)
     except ValueError:
         logger.exception(
-            "Fail to read data from buffered stream %r", sock)
+            "Fail to read data from buffered stream %r", conn.sock)
         raise
     finally:
-        t_end = dt.now().timestamp()
-        t_dur = t_end - t_start
-        logger.info("[Received: %d bytes (%d raw bytes)] \
+        result = __finish(conn.iofilter, t_start, conn.recvd)
+
+    return result
+
+
+def __finish(iofilter, t_start, recvd):
+    t_end = time.monotonic()
+    t_dur = t_end - t_start
+    logger.info("[Received: %d bytes (%d raw bytes)] \
 [Duration: %s seconds] [Bitrate: %s bit/s]",
-                    recvd,
-                    iofilter.get_count(),
-                    t_dur, recvd * 8 / t_dur)
-        iofilter.close()
-        logger.info("Socket closed")
+                recvd,
+                iofilter.get_count(),
+                t_dur, recvd * 8 / t_dur)
+    iofilter.close()
+    logger.info("Socket closed")
 
     return t_start, t_end, recvd, iofilter.get_count()
 
 
+def __recv_ready(conn, bufsize, debug_enabled, host_addr):
+    left = conn.left
+    bytes_obj, ctrl_num = conn.iofilter.read(
+        bufsize if left >= bufsize else left)
+
+    if ctrl_num:
+        if conn.byte_mem is not None:
+            conn.mem_pos = __cache(conn.byte_mem, conn.mem_pos, bytes_obj)
+
+        byte_length = len(bytes_obj)
+        conn.recvd += byte_length
+        conn.left -= ctrl_num
+
+        if debug_enabled:
+            logger.debug("Received %d bytes of data from %s (summary %s)",
+                         byte_length, host_addr, Util.summarize(bytes_obj))
+
+    return ctrl_num
+
+
+def __run_select(classobj, args_ns, p_sizes, mem_limit_bs):
+    """Receive data from all the servers in the current thread.
+
+    The sockets stay in blocking mode and are only read once the selector
+    reports them ready, so a read with the raw method never blocks. Other
+    methods may block on one socket until enough data has arrived.
+
+    """
+    bufsize = args_ns.bufsize
+    debug_enabled = logger.isEnabledFor(logging.DEBUG)
+
+    multi_results = [None] * len(p_sizes)
+    conns = []
+    sel = selectors.DefaultSelector()
+    try:
+        for idx, size in enumerate(p_sizes):
+            conns.append(
+                __connect(idx, classobj, args_ns, size, mem_limit_bs))
+
+        # Start timing only after all the connections are set up
+        t_start = time.monotonic()
+        for conn in conns:
+            conn.t_start = t_start
+            if conn.left > 0:
+                sel.register(conn.sock, selectors.EVENT_READ, conn)
+            else:
+                # Nothing to receive if the size is less than the number
+                # of servers
+                multi_results[conn.idx] = __finish(
+                    conn.iofilter, conn.t_start, conn.recvd)
+
+        while sel.get_map():
+            for key, _ in sel.select():
+                conn = key.data
+                try:
+                    ctrl_num = __recv_ready(conn, bufsize, debug_enabled,
+                                            args_ns.host_addrs[conn.idx])
+                except ValueError:
+                    logger.exception(
+                        "Fail to read data from buffered stream %r",
+                        key.fileobj)
+                    raise
+
+                if not ctrl_num or conn.left <= 0:
+                    sel.unregister(key.fileobj)
+                    multi_results[conn.idx] = __finish(
+                        conn.iofilter, conn.t_start, conn.recvd)
+    finally:
+        for conn in conns:
+            if multi_results[conn.idx] is None:
+                conn.iofilter.close()
+        sel.close()
+
+    return multi_results
+
+
 def __allot_size(size, num):
     i_size = size // num
     left = size - i_size * num
@@ -176,7 +427,8 @@ def __allot_size(size, num):
 
 
 def __do_start(args_ns):
-    logger.info("[bufsize: %d bytes]", args_ns.bufsize)
+    logger.info("[bufsize: %d bytes] [io backend: %s]",
+                args_ns.bufsize, args_ns.io_backend)
 
     num_servs = len(args_ns.host_addrs)
 
@@ -185,12 +437,25 @@ def __do_start(args_ns):
 
     mem_limit_bs = args_ns.cache // num_servs
 
-    with Pool(processes=num_servs) as pool:
-        futures = [pool.apply_async(__run,
-                                    (idx, classobj, args_ns,
-                                     size, mem_limit_bs))
-                   for idx, size in enumerate(p_sizes)]
-        multi_results = [f.get() for f in futures]
+    if args_ns.io_backend == 'select':
+        multi_results = __run_select(
+            classobj, args_ns, p_sizes, mem_limit_bs)
+    elif args_ns.io_backend == 'thread':
+        # Receiving from sockets releases the GIL, so threads are enough to
+        # keep all the connections busy without the cost of starting
+        # processes and pickling the arguments and results.
+        with ThreadPoolExecutor(max_workers=num_servs) as pool:
+            futures = [pool.submit(__run, idx, classobj, args_ns,
+                                   size, mem_limit_bs)
+                       for idx, size in enumerate(p_sizes)]
+            multi_results = [f.result() for f in futures]
+    else:
+        with Pool(processes=num_servs) as pool:
+            futures = [pool.apply_async(__run,
+                                        (idx, classobj, args_ns,
+                                         size, mem_limit_bs))
+                       for idx, size in enumerate(p_sizes)]
+            multi_results = [f.get() for f in futures]
 
     t_starts, t_ends, recvds, raw_bytes_reads = zip(*multi_results)
     total_dur = max(t_ends) - min(t_starts)
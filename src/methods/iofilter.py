@@ -130,7 +130,9 @@ class IOFilter(typing.Generic[T]):
 
         Returns:
             typing.Tuple[bytes, int]: The result bytes and a control number
-                that associates with the bytes.
+                that associates with the bytes. The result bytes can be a
+                view of the internal buffer which is only valid until the
+                next read.
 
         """
         if size is None or size <= 0:
@@ -23,6 +23,28 @@ class Linspace(iofilter.IOFilter[iofilter.T]):
     def _get_bufarray_size(self, bufsize: int) -> int:
         return bufsize * self.kwargs[self.PARAM_STEP]
 
+    def _pick(self, view: memoryview, end: int) -> memoryview:
+        """Gather every step-th byte of view[:end] into the output buffer.
+
+        Returns:
+            memoryview: A view of the output buffer which is only valid
+                until the next read.
+
+        """
+        step = self.kwargs[self.PARAM_STEP]
+        if step == 1:
+            return view[:end]
+
+        if not hasattr(self, '_outview'):
+            # pylint: disable=attribute-defined-outside-init
+            self._outview = memoryview(bytearray(len(self._buffer) // step))
+
+        # The strided copy goes straight into the preallocated buffer
+        # instead of allocating a bytes object per read
+        nbytes = (end + step - 1) // step
+        self._outview[:nbytes] = view[:end:step]
+        return self._outview[:nbytes]
+
     @classmethod
     def _get_method_params(cls: typing.Type['Linspace']) -> typing.List[
             iofilter.MethodParam]:
@@ -68,7 +90,7 @@ class LinspaceIO(Linspace[BufferedIOBase]):
             start += nbytes
 
         self._incr_count(end)
-        return (view[:end][::step].tobytes(), size)
+        return (self._pick(view, end), size)
 
 
 class LinspaceSocket(Linspace[socket]):
@@ -98,5 +120,5 @@ class LinspaceSocket(Linspace[socket]):
 
         self._incr_count(start)
 
-        res_bytes = view[:start][::step].tobytes()
-        return (res_bytes, len(res_bytes))
+        res_view = self._pick(view, start)
+        return (res_view, len(res_view))
@@ -1,18 +1,22 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from collections import deque
 from enum import Enum
-from datetime import datetime as dt
 from inspect import getfullargspec
 from io import BufferedIOBase
 from multiprocessing import Pool
+from multiprocessing.sharedctypes import RawArray
 from socket import socket
 
 import abc
+import ast
+import ctypes
+import functools
 import logging
+import types
 import typing
 import os
+import time
 
 import iofilter
 
@@ -28,6 +32,33 @@ class Match(iofilter.IOFilter[iofilter.T]):
     PARAM_FUNC = 'func'
     PARAM_SIZETYPE = 'sztype'
 
+    def __init__(
+            self: 'Match',
+            stream: iofilter.T,
+            bufsize: int,
+            **kwargs) -> None:
+        """Initialize the function check for instance of this class.
+
+        Attributes:
+            _vec_func (typing.Optional[typing.Callable[[bytes], bytes]]):
+                The vectorized function check, or None if the function
+                check has to be applied byte by byte.
+            _spec_loops (typing.Optional[ScalarLoops]): The scalar loops
+                with the function check inlined, or None if the function
+                check is not a lambda expression that can be inlined.
+
+        """
+        super().__init__(stream, bufsize, **kwargs)
+
+        self._vec_func = _vectorize(kwargs[self.PARAM_FUNC])
+        self._spec_loops = spec_loops.get(kwargs[self.PARAM_FUNC])
+        if self._vec_func is not None:
+            self.logger.info("Use vectorized function check")
+        elif self._spec_loops is not None:
+            self.logger.info("Use specialized scalar function check")
+        else:
+            self.logger.info("Use scalar function check")
+
     @classmethod
     def _get_method_params(cls: typing.Type['Match']) -> typing.List[
             iofilter.MethodParam]:
@@ -75,7 +106,7 @@ class Match(iofilter.IOFilter[iofilter.T]):
             cls: typing.Type['Match'],
             expr: str) -> typing.Callable[[int], object]:
         try:
-            func = eval(expr)  # pylint: disable=eval-used
+            func = _compile_func(expr)
         except Exception:
             cls.logger.exception(
                 "Unable to parse function expression: %s", expr)
@@ -103,6 +134,21 @@ class Match(iofilter.IOFilter[iofilter.T]):
 
         return self._read_after(size)
 
+    def _filter(self: 'Match', byte_arr: bytes, res: bytearray) -> None:
+        """Append the bytes that match the function check to res."""
+        if self._vec_func is not None:
+            res += self._vec_func(byte_arr)
+            return
+
+        if self._spec_loops is not None:
+            self._spec_loops.append_to(byte_arr, res)
+            return
+
+        func = self.kwargs[self.PARAM_FUNC]
+        for byt_val in byte_arr:
+            if func(byt_val):
+                res.append(byt_val)
+
     @abc.abstractmethod
     def _read_before(self: 'Match', size: int) -> typing.Tuple[bytes, int]:
         pass
@@ -116,15 +162,193 @@ class Match(iofilter.IOFilter[iofilter.T]):
 expr_func = lambda v: v  # noqa: E731
 
 
-def _check(byte_arr: bytearray, res: bytearray = None) -> bytearray:
-    if res is None:
-        res = bytearray()
+ScalarLoops = typing.NamedTuple('ScalarLoops', [
+    ('append_to', typing.Callable[[bytes, bytearray], None]),
+    ('write_into', typing.Callable[[memoryview, memoryview, int], int])])
+
+# The scalar loops generated for the function checks, keyed by the function
+# pylint: disable=invalid-name
+spec_loops = {}  # type: typing.Dict[typing.Callable, ScalarLoops]
+
+# The templates of the scalar loops. ARG is renamed to the parameter of the
+# lambda expression and BODY is replaced by its body.
+_SPEC_LOOPS_SOURCE = """
+def append_to(byte_arr, res):
+    append = res.append
+    for ARG in byte_arr:
+        if BODY:
+            append(ARG)
+
+
+def write_into(src, dst, offset):
+    for ARG in src:
+        if BODY:
+            dst[offset] = ARG
+            offset += 1
+    return offset
+"""
+_SPEC_LOOPS_NAMES = frozenset(
+    ('ARG', 'BODY', 'byte_arr', 'res', 'append', 'src', 'dst', 'offset'))
+
+
+class _Inliner(ast.NodeTransformer):
+    """Substitute the lambda expression into the loop templates."""
+
+    def __init__(self: '_Inliner', arg: str, body: ast.expr) -> None:
+        self.__arg = arg
+        self.__body = body
+
+    # pylint: disable=invalid-name
+    def visit_Name(self: '_Inliner', node: ast.Name) -> ast.expr:
+        """Replace the placeholder names."""
+        if node.id == 'ARG':
+            return ast.copy_location(
+                ast.Name(id=self.__arg, ctx=node.ctx), node)
+        if node.id == 'BODY':
+            return self.__body
+        return node
+
+
+def _specialize(func_expr: ast.expr) -> typing.Optional[ScalarLoops]:
+    """Generate the scalar loops with the function check inlined.
+
+    The body of the lambda expression becomes the condition of the loops,
+    which saves a Python function call for every byte.
+
+    Returns:
+        typing.Optional[ScalarLoops]: The generated loops, or None if the
+            expression is not a lambda of a single plain parameter, or it
+            uses a name of the templates.
+
+    """
+    if not isinstance(func_expr, ast.Lambda):
+        return None
+
+    args = func_expr.args
+    if len(args.args) != 1 or args.vararg or args.kwonlyargs \
+            or args.kwarg or args.defaults:
+        return None
+
+    arg = args.args[0].arg
+    names = {node.id for node in ast.walk(func_expr.body)
+             if isinstance(node, ast.Name)}
+    if arg in _SPEC_LOOPS_NAMES or names & _SPEC_LOOPS_NAMES:
+        return None
+
+    tree = _Inliner(arg, func_expr.body).visit(ast.parse(_SPEC_LOOPS_SOURCE))
+    code = compile(ast.fix_missing_locations(tree), '<func>', 'exec')
+
+    # Resolve the global names the same way as the lambda function does
+    # without defining the loops in this module.
+    funcs = {const.co_name: types.FunctionType(const, globals())
+             for const in code.co_consts
+             if isinstance(const, types.CodeType)}
+    return ScalarLoops(funcs['append_to'], funcs['write_into'])
+
+
+# Every connection creates its own instance with the same expression, so
+# only parse and compile it the first time.
+@functools.lru_cache(maxsize=64)
+def _compile_func(expr: str) -> typing.Callable[[int], object]:
+    tree = ast.parse(expr, mode='eval')
+    func = eval(compile(tree, '<func>', 'eval'))  # pylint: disable=eval-used
+
+    loops = _specialize(tree.body)
+    if loops is not None:
+        spec_loops[func] = loops
+
+    return func
+
+
+def _vectorize(
+        func: typing.Callable[[int], object]) -> typing.Optional[
+            typing.Callable[[bytes], bytes]]:
+    """Compile the function check into a vectorized filter.
+
+    Since the function check only accepts the int value of a byte, its
+    truth value over all the 256 possible values can be tabulated once, and
+    the filtering becomes a bytes.translate() call that deletes the bytes
+    not matching, which runs entirely in C.
+
+    Returns:
+        typing.Optional[typing.Callable[[bytes], bytes]]: A function that
+            returns the matching bytes, or None if the function check can't
+            be tabulated, e.g. when it raises on some value or it gives
+            different results for the same value.
+
+    """
+    try:
+        delete = bytes(v for v in range(256) if not func(v))
+        if delete != bytes(v for v in range(256) if not func(v)):
+            return None
+    except Exception:  # pylint: disable=broad-except
+        return None
+
+    def _vec_check(byte_arr: bytes) -> bytes:
+        return bytes(byte_arr).translate(None, delete)
+
+    return _vec_check
+
+
+# pylint: disable=invalid-name
+shm_views = None  # type: typing.Optional[typing.Tuple[memoryview, memoryview]]
+
+
+def _init_shm_views(in_arr: RawArray, out_arr: RawArray) -> None:
+    global shm_views  # pylint: disable=invalid-name
+    shm_views = (memoryview(in_arr).cast('B'), memoryview(out_arr).cast('B'))
+
 
-    for byt in byte_arr:
+def _check_shm(start: int, end: int) -> int:
+    """Filter the shared input buffer in place of pickling the data.
+
+    The matching bytes are written to the shared output buffer at the same
+    offset, which never overlaps with other workers since the result is
+    never longer than the input. Subprocesses are only used for the scalar
+    function check.
+
+    Returns:
+        int: The number of matching bytes written.
+
+    """
+    in_view, out_view = shm_views
+
+    loops = spec_loops.get(expr_func)
+    if loops is not None:
+        return loops.write_into(in_view[start:end], out_view, start) - start
+
+    # Write straight to the output buffer instead of collecting the
+    # matching bytes in an intermediate bytearray first
+    offset = start
+    for byt in in_view[start:end]:
         if expr_func(byt):
-            res.append(byt)
+            out_view[offset] = byt
+            offset += 1
+
+    return offset - start
+
 
-    return res
+# Except the last one, the reads are always of the same size, so the
+# offsets only need to be computed once.
+@functools.lru_cache(maxsize=16)
+def _allot_work_offsets(
+        total_size: int,
+        min_proc_worksize: int) -> typing.Tuple[typing.Tuple[int, int], ...]:
+    least_num_procs = total_size // min_proc_worksize
+    work_sizes = [min_proc_worksize] * least_num_procs
+    left = total_size - least_num_procs * min_proc_worksize
+    if left >= min_proc_worksize / 2 or not least_num_procs:
+        work_sizes.append(left)
+    else:
+        work_sizes[-1] += left
+
+    work_offsets = []
+    start = 0
+    for wsize in work_sizes:
+        work_offsets.append((start, start + wsize))
+        start += wsize
+
+    return tuple(work_offsets)
 
 
 class MatchIO(Match[BufferedIOBase]):
@@ -147,13 +371,11 @@ class MatchIO(Match[BufferedIOBase]):
         super().__init__(stream, bufsize, **kwargs)
         self.__first_read = True
 
-        global expr_func  # pylint: disable=invalid-name
-        # Make this variable global so all the subprocesses can inherit
-        # this variable automatically
-        expr_func = kwargs[self.PARAM_FUNC]
-
         num_procs = int(bufsize / kwargs[self.PARAM_MINPROCWORKSIZE] + 0.5)
-        if num_procs < 1:
+        if num_procs < 1 or self._vec_func is not None:
+            # The vectorized function check runs in C, splitting the work
+            # to subprocesses only adds the cost of forking and the
+            # interprocess communication.
             num_procs = 1
         else:
             num_usable_cpus = len(os.sched_getaffinity(0))
@@ -168,7 +390,22 @@ class MatchIO(Match[BufferedIOBase]):
 
         self._procs_pool = None
         if num_procs > 1:
-            self._procs_pool = Pool(processes=num_procs)
+            global expr_func  # pylint: disable=invalid-name
+            # Make this variable global so all the subprocesses can inherit
+            # this variable automatically
+            expr_func = kwargs[self.PARAM_FUNC]
+
+            # Share the read buffer and the result buffer with the
+            # subprocesses so only the offsets need to be sent to them.
+            bufarray_size = self._get_bufarray_size(bufsize)
+            in_arr = RawArray(ctypes.c_ubyte, bufarray_size)
+            out_arr = RawArray(ctypes.c_ubyte, bufarray_size)
+            self._buffer = in_arr
+            self._bufview = memoryview(in_arr).cast('B')
+            self._outview = memoryview(out_arr).cast('B')
+            self._procs_pool = Pool(processes=num_procs,
+                                    initializer=_init_shm_views,
+                                    initargs=(in_arr, out_arr))
         self.logger.info("Start %d process%s to handle data filtering",
                          num_procs,
                          'es' if num_procs > 1 else '')
@@ -185,7 +422,8 @@ class MatchIO(Match[BufferedIOBase]):
                 Util.human2bytes,
                 'The minimum number of bytes that handle by each process \
                 each time. The number of processes in use depends on the \
-                bufsize and this value.',
+                bufsize and this value. Only used when the function check \
+                can not be vectorized.',
                 '50MB'
             )
         )
@@ -203,23 +441,12 @@ class MatchIO(Match[BufferedIOBase]):
             self._resbuf = bytearray()
         else:
             ret_res = self._resbuf[:size]
-            self._resbuf = self._resbuf[size:]
+            # Deleting from the front of a bytearray only advances its
+            # internal start offset, unlike slicing which copies all the
+            # remaining bytes to a new bytearray.
+            del self._resbuf[:size]
         return ret_res
 
-    def __allot_work_sizes(
-            self: 'MatchIO', total_size: int) -> typing.List[int]:
-        min_proc_worksize = self.kwargs[self.PARAM_MINPROCWORKSIZE]
-
-        least_num_procs = total_size // min_proc_worksize
-        work_sizes = [min_proc_worksize] * least_num_procs
-        left = total_size - least_num_procs * min_proc_worksize
-        if left >= min_proc_worksize / 2 or not least_num_procs:
-            work_sizes.append(left)
-        else:
-            work_sizes[-1] += left
-
-        return work_sizes
-
     def _read_before(self: 'MatchIO', size: int) -> typing.Tuple[bytes, int]:
         view = self._get_or_create_bufview()
 
@@ -238,31 +465,26 @@ class MatchIO(Match[BufferedIOBase]):
         self._incr_count(nbytes)
         view = self._get_or_create_bufview()
 
-        t_start = dt.now().timestamp()
+        t_start = time.monotonic()
 
         if self._procs_pool is None:
-            _check(view[:nbytes], res=self._resbuf)
+            self._filter(view[:nbytes], self._resbuf)
         else:
-            work_sizes = self.__allot_work_sizes(nbytes)
-            self.logger.debug("work sizes of processes in bytes: %r",
-                              work_sizes)
-
-            prev_offset = 0
-            future_results = []
-            for wsize in work_sizes:
-                next_offset = wsize + prev_offset
-                future_results.append(
-                    self._procs_pool.apply_async(
-                        _check,
-                        (bytearray(view[prev_offset:next_offset]),))
-                )
-                prev_offset = next_offset
-
-            for f_res in future_results:
-                self._resbuf.extend(f_res.get())
+            work_offsets = _allot_work_offsets(
+                nbytes, self.kwargs[self.PARAM_MINPROCWORKSIZE])
+            self.logger.debug("work offsets of processes in bytes: %r",
+                              work_offsets)
+
+            future_results = [
+                (start,
+                 self._procs_pool.apply_async(_check_shm, (start, end)))
+                for start, end in work_offsets]
+
+            for offset, f_res in future_results:
+                self._resbuf += self._outview[offset:offset + f_res.get()]
 
         if self.logger.isEnabledFor(logging.DEBUG):
-            t_dur = dt.now().timestamp() - t_start
+            t_dur = time.monotonic() - t_start
             self.logger.debug(
                 "Took %s seconds to filter %d bytes of data",
                 t_dur,
@@ -297,6 +519,10 @@ class MatchIO(Match[BufferedIOBase]):
 class MatchSocket(Match[socket]):
     """Read the bytes from socket that match the function check."""
 
+    # The minimum size of the receive buffer when the size is for the
+    # filtering result (AFTER)
+    _MIN_AFTER_BUFSIZE = 256 << 10
+
     def __init__(
             self: 'MatchSocket',
             stream: socket,
@@ -305,51 +531,56 @@ class MatchSocket(Match[socket]):
         """Initialize addtional attribute for instance of this class.
 
         Attributes:
-            __byteque (typing.Deque[int]): Store the read bytes from
-                the underlying stream.
+            __matched (bytearray): Store the matching bytes that have been
+                filtered from the underlying stream but not returned yet.
 
         """
         super().__init__(stream, bufsize, **kwargs)
-        self.__byteque = deque()  # type: typing.Deque[int]
+        self.__matched = bytearray()
+
+    def _get_bufarray_size(self: 'MatchSocket', bufsize: int) -> int:
+        if self.kwargs[self.PARAM_SIZETYPE] == self.SizeType.AFTER:
+            return max(bufsize, self._MIN_AFTER_BUFSIZE)
+        return bufsize
 
     def _read_after(self: 'MatchSocket', size: int) -> typing.Tuple[
             bytes, int]:
-        res = bytearray()
         view = self._get_or_create_bufview()
-        func = self.kwargs[self.PARAM_FUNC]
 
-        while True:
-            if self.__byteque:
-                try:
-                    while True:
-                        byt_val = self.__byteque.popleft()  # type: int
-                        if func(byt_val):
-                            res.append(byt_val)
-                            if len(res) == size:
-                                return (res, size)
-                except IndexError:
-                    pass
-
-            nbytes = self._stream.recv_into(view, size)
+        # Filter the received bytes right on the receive buffer instead of
+        # queueing them up to be checked one by one.
+        while len(self.__matched) < size:
+            # The matching bytes beyond the size are kept for the next
+            # reads, so receive as much as the buffer can hold to save the
+            # number of system calls.
+            nbytes = self._stream.recv_into(view)
             if not nbytes:
+                res = self.__matched
+                self.__matched = bytearray()
                 return (res, len(res))
 
             self._incr_count(nbytes)
-            self.__byteque.extend(view[:nbytes])
+            self._filter(view[:nbytes], self.__matched)
+
+        res = self.__matched[:size]
+        del self.__matched[:size]
+        return (res, size)
 
     def _read_before(self: 'MatchSocket', size: int) -> typing.Tuple[
             bytes, int]:
-        res = bytearray()
         view = self._get_or_create_bufview()
 
         nbytes = self._stream.recv_into(view, size)
         if not nbytes:
-            return (res, 0)
+            return (bytearray(), 0)
 
         self._incr_count(nbytes)
 
-        func = self.kwargs[self.PARAM_FUNC]
-        for byt_val in view[:nbytes]:
-            if func(byt_val):
-                res.append(byt_val)
+        if self._vec_func is not None:
+            # The vectorized function check already returns a new bytes
+            # object, so return it as is without copying.
+            return (self._vec_func(view[:nbytes]), nbytes)
+
+        res = bytearray()
+        self._filter(view[:nbytes], res)
         return (res, nbytes)
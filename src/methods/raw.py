@@ -5,6 +5,7 @@ from io import BufferedIOBase
 from socket import socket
 
 import logging
+import mmap
 import typing
 
 import iofilter
@@ -19,20 +20,47 @@ class Raw(iofilter.IOFilter[iofilter.T]):
 class RawIO(Raw[BufferedIOBase]):
     """Read from file and return raw data without any filtering."""
 
+    def __init__(
+            self: 'RawIO',
+            stream: BufferedIOBase,
+            bufsize: int,
+            **kwargs) -> None:
+        """Map the whole file into memory for reading."""
+        super().__init__(stream, bufsize, **kwargs)
+
+        # Return views of the mapped file instead of copying the data into
+        # the buffer. The mapping is unmapped once the last view is gone.
+        mapped = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mapped, 'madvise'):
+            # Python 3.8+
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+            mapped.madvise(mmap.MADV_WILLNEED)
+
+        self.__mapview = memoryview(mapped)
+        self.__pos = 0
+
+    def _get_bufarray_size(self: 'RawIO', _bufsize: int) -> int:
+        return 0
+
     def read(self, size: int) -> typing.Tuple[bytes, int]:
         """Read data from the file stream."""
         super().read(size)
 
-        view = self._get_or_create_bufview()
-        while True:
-            nbytes = self._stream.readinto(view[:size])
+        fsize = len(self.__mapview)
+        start = self.__pos
+        if start >= fsize:
+            start = 0
+
+        view = self.__mapview[start:start + size]
+        nbytes = len(view)
 
-            if nbytes < size:
-                self._stream.seek(0)
+        # Wrap around to the beginning as soon as the end of file is
+        # reached, so that a read never comes back empty
+        end = start + nbytes
+        self.__pos = end if end < fsize else 0
 
-            if nbytes:
-                self._incr_count(nbytes)
-                return (self._buffer[:nbytes], nbytes)
+        self._incr_count(nbytes)
+        return (view, nbytes)
 
 
 class RawSocket(Raw[socket]):
@@ -42,7 +70,10 @@ class RawSocket(Raw[socket]):
         """Read data from the socket stream."""
         super().read(size)
 
-        nbytes = self._stream.recv_into(self._buffer, size)
+        # Return a view of the buffer instead of a copy of the data so no
+        # bytes object is allocated per read
+        view = self._get_or_create_bufview()
+        nbytes = self._stream.recv_into(view, size)
         self._incr_count(nbytes)
 
-        return (self._buffer[:nbytes], nbytes)
+        return (view[:nbytes], nbytes)
@@ -1,14 +1,17 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from argparse import Namespace
-from datetime import datetime as dt
+from argparse import ArgumentTypeError, Namespace
 from io import BufferedIOBase
+from multiprocessing import Process
 
+import gc
+import glob
 import logging
 import os
 import socket
 import tempfile
+import time
 
 from paramparser import ParameterParser
 from util import Util
@@ -30,14 +33,34 @@ def __populate_start_parser(start_parser):
     start_parser.add_argument(
         '-f', '--filename', metavar='FN', type=str,
         help='Read from this file and write to the network, \
-              instead of generating a temporary file with random data')
+              instead of a file of random data. The random data file is \
+              generated once and kept for later runs with the same size \
+              in $XDG_CACHE_HOME/pyben-nio (default: ~/.cache/pyben-nio). \
+              The cache holds one file of SIZE bytes for every size used, \
+              remove the directory to reclaim the space')
     start_parser.add_argument(
         '-l', '--bufsize', metavar='BS', type=str,
         help='The maximum amount of data to be sent at once \
-              (default: 4KB) ([BKMG])',
-        default='4KB')
+              (default: 64KB) ([BKMG])',
+        default='64KB')
+    start_parser.add_argument(
+        '-S', '--sndbuf', type=str,
+        help='The size of the socket send buffer (SO_SNDBUF). Leave it \
+              unset to keep the send buffer auto-tuning of the kernel \
+              (see tcp(7)) ([BKMG])')
+    start_parser.add_argument(
+        '-w', '--workers', metavar='NUM', type=__positive_int,
+        help='The number of clients to serve concurrently, each by its own \
+              process sending the full size of data (default: 1)',
+        default=1)
+    start_parser.add_argument(
+        '-C', '--cpu', type=int,
+        help='Pin the server to this CPU, preferably the one handling the \
+              interrupts of the network device. With multiple workers, \
+              the i-th worker (counting from 0) is pinned to CPU + i \
+              (see sched_setaffinity(2))')
 
-    # Since socket.sendfile() performs the data reading and sending within
+    # Since sendfile() performs the data reading and sending within
     # the kernel space, there is no user space function can inject into
     # during this process. Therefore the zerocopy option is conflicting with
     # the method option.
@@ -51,24 +74,75 @@ def __populate_start_parser(start_parser):
         default='raw')
     group.add_argument(
         '-z', '--zerocopy', action='store_true',
-        help='Use "socket.sendfile()" instead of "socket.send()".')
-
-    start_parser.set_defaults(func=__handle_start)
-
+        help='Use "os.sendfile()" instead of "socket.sendall()".')
+    start_parser.add_argument(
+        '-P', '--prefilter', action='store_true',
+        help='Apply the data filtering method to the whole file once \
+              before accepting the client, then send the result over and \
+              over with "os.sendfile()". The result is kept in \
+              /dev/shm if it has room for the whole data file, e.g. run \
+              Docker with --shm-size. Not allowed with -z, which sends \
+              the file as is.')
+
+    start_parser.set_defaults(
+        func=lambda arg_attrs_ns: __handle_start(start_parser, arg_attrs_ns))
+
+
+def __positive_int(string):
+    value = int(string)
+    if value < 1:
+        raise ArgumentTypeError("must be >= 1, got {!r}".format(string))
+    return value
+
+
+def __handle_start(start_parser, arg_attrs_ns):
+    # -P still takes the method from -m, so it can't join the mutually
+    # exclusive group of -m and -z
+    if arg_attrs_ns.zerocopy and arg_attrs_ns.prefilter:
+        start_parser.error(
+            'argument -P/--prefilter: not allowed with argument -z/--zerocopy')
+
+    # Check the CPUs of all the workers before starting any of them, since
+    # a worker that fails to pin itself leaves its client unserved
+    if arg_attrs_ns.cpu is not None:
+        cpus = set(range(arg_attrs_ns.cpu,
+                         arg_attrs_ns.cpu + arg_attrs_ns.workers))
+        usable_cpus = os.sched_getaffinity(0)
+        if not cpus <= usable_cpus:
+            start_parser.error(
+                'argument -C/--cpu: CPU {} not in the usable CPUs {}'.format(
+                    ', '.join(str(c) for c in sorted(cpus - usable_cpus)),
+                    sorted(usable_cpus)))
 
-def __handle_start(arg_attrs_ns):
     args_ns = Namespace(
         bind_addr=arg_attrs_ns.bind,
         size=Util.human2bytes(arg_attrs_ns.size),
         port=arg_attrs_ns.port,
         filename=arg_attrs_ns.filename,
         bufsize=Util.human2bytes(arg_attrs_ns.bufsize),
+        sndbuf=Util.human2bytes(arg_attrs_ns.sndbuf)
+        if arg_attrs_ns.sndbuf else None,
+        workers=arg_attrs_ns.workers,
+        cpu=arg_attrs_ns.cpu,
         method=ParameterParser.split_multi_value_param(arg_attrs_ns.method),
-        zerocopy=arg_attrs_ns.zerocopy)
+        zerocopy=arg_attrs_ns.zerocopy,
+        prefilter=arg_attrs_ns.prefilter)
 
     __do_start(args_ns)
 
 
+def __remove_stale_tmp(cache_dir):
+    # Remove the temporary files left behind by runs that were killed
+    # while generating. Files still being written by another run have
+    # been modified recently, so leave them alone.
+    for tmp_path in glob.glob(os.path.join(cache_dir, 'random-*.tmp')):
+        try:
+            if time.time() - os.stat(tmp_path).st_mtime > 60:
+                os.remove(tmp_path)
+        except OSError:
+            pass
+
+
 def __validate_file(filename, size):
     if filename:
         try:
@@ -77,20 +151,104 @@ def __validate_file(filename, size):
             logger.exception("Can't open %s", filename)
             raise
 
-    file_obj = tempfile.TemporaryFile('w+b')
-    logger.info("Generating temporary file of size %d bytes ...", size)
+    # Keep the generated file for later runs with the same size. The cache
+    # is private to the user, so the file can't be replaced by others.
+    cache_dir = os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+        'pyben-nio')
+    cache_path = os.path.join(cache_dir, 'random-{:d}.bin'.format(size))
     try:
-        file_obj.write(os.urandom(size))
-        file_obj.seek(0)
+        file_obj = open(cache_path, "rb")
+        fsize = os.fstat(file_obj.fileno()).st_size
+        if fsize == size:
+            logger.info("Reusing data file %s", cache_path)
+            return file_obj
+        file_obj.close()
+        logger.warning("Data file %s has %d bytes instead of %d, "
+                       "generating it again", cache_path, fsize, size)
+    except FileNotFoundError:
+        pass
+    except OSError as err:
+        logger.warning("Can't reuse data file %s (%s), generating it again",
+                       cache_path, err)
+
+    try:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
     except OSError:
-        logger.exception("Can't write to temporary file")
+        logger.exception("Can't create cache directory %s", cache_dir)
+        raise
+
+    __remove_stale_tmp(cache_dir)
+
+    # Write to a temporary file first and rename it when complete, so an
+    # interrupted run never leaves a partial data file behind for reuse.
+    file_obj = tempfile.NamedTemporaryFile(
+        'w+b', prefix='random-', suffix='.tmp', dir=cache_dir, delete=False)
+    logger.info("Generating data file %s of size %d bytes ...",
+                cache_path, size)
+    try:
+        # Generate the data in chunks so that the memory usage does not
+        # grow with the file size
+        chunk_size = 1 << 20
+        num_chunks, remainder = divmod(size, chunk_size)
+        for _ in range(num_chunks):
+            file_obj.write(os.urandom(chunk_size))
+        file_obj.write(os.urandom(remainder))
         file_obj.close()
+        os.replace(file_obj.name, cache_path)
+    except OSError:
+        logger.exception("Can't write to data file %s", cache_path)
         raise
+    finally:
+        # Also reached on KeyboardInterrupt. The temporary file only
+        # exists here if it has not been renamed.
+        file_obj.close()
+        if os.path.exists(file_obj.name):
+            os.remove(file_obj.name)
 
-    return file_obj
+    return open(cache_path, "rb")
 
 
-def __setup_socket(bind_addr, port):
+def __prefilter(iofilter, fsize, bufsize):
+    # /dev/shm is usually a tmpfs, so sendfile() reads the filtered data
+    # from memory. It can be small though, e.g. 64MB in a Docker container
+    # by default, so only use it if even unfiltered data would fit.
+    tmp_dir = None
+    try:
+        shm_stat = os.statvfs('/dev/shm')
+        if shm_stat.f_bavail * shm_stat.f_frsize >= fsize:
+            tmp_dir = '/dev/shm'
+        else:
+            logger.warning("Not enough space in /dev/shm for %d bytes, "
+                           "keep the filtered data in %s instead",
+                           fsize, tempfile.gettempdir())
+    except OSError:
+        pass
+    filtered_obj = tempfile.TemporaryFile('w+b', dir=tmp_dir)
+    logger.info("Prefiltering data file of size %d bytes ...", fsize)
+    try:
+        while iofilter.get_count() < fsize:
+            bytes_obj, _ = iofilter.read(bufsize)
+            filtered_obj.write(bytes_obj)
+        filtered_obj.seek(0)
+    except (OSError, ValueError):
+        logger.exception("Can't prefilter the data file")
+        filtered_obj.close()
+        raise
+    finally:
+        iofilter.close()
+
+    filtered_fsize = os.fstat(filtered_obj.fileno()).st_size
+    if not filtered_fsize:
+        filtered_obj.close()
+        raise RuntimeError("Invalid filtered file size", filtered_fsize)
+
+    logger.info("Filtered %d raw bytes into %d bytes",
+                iofilter.get_count(), filtered_fsize)
+    return filtered_obj, filtered_fsize
+
+
+def __setup_socket(bind_addr, port, sndbuf, backlog):
     # Create TCP socket
     try:
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -113,9 +271,24 @@ def __setup_socket(bind_addr, port):
         sock = None
         raise
 
+    if sndbuf:
+        # The accepted socket inherits the buffer size from the listening
+        # socket.
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+        except socket.error:
+            logger.exception("Unable to set SO_SNDBUF to %d bytes", sndbuf)
+            sock.close()
+            sock = None
+            raise
+
+        # The kernel doubles the value and caps it by net.core.wmem_max
+        logger.info("[SO_SNDBUF: %d bytes]",
+                    sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF))
+
     # Listen
     try:
-        sock.listen(1)
+        sock.listen(backlog)
     except socket.error:
         logger.exception("Unable to listen()")
         sock.close()
@@ -125,53 +298,83 @@ def __setup_socket(bind_addr, port):
     return sock
 
 
-def __zerosend(left, fsize, file_obj, client_s):
-    bys = min(left, fsize)
-
-    # pylint: disable=no-member
-    client_s.sendfile(file_obj, count=bys)
-    logger.debug("Sent %d bytes of data", bys)
-    return bys
+def __set_cork(client_s, enable):
+    # With TCP_CORK set, the kernel only sends out full-sized segments,
+    # and clearing it flushes the partial segment that is pending.
+    # See tcp(7)
+    if not hasattr(socket, 'TCP_CORK'):
+        return
 
+    try:
+        client_s.setsockopt(
+            socket.IPPROTO_TCP, socket.TCP_CORK, 1 if enable else 0)
+    except socket.error:
+        logger.warning("Unable to %s TCP_CORK", 'set' if enable else 'clear')
 
-def __send(left, bufsize, iofilter, client_s):
-    bys = min(left, bufsize)
-    bytes_obj, ctrl_num = iofilter.read(bys)
-
-    # Applications are responsible for checking that all data has been sent.
-    #   https://docs.python.org/3/howto/sockets.html#using-a-socket
-    byte_length = len(bytes_obj)
-    num_sent = 0
-    while num_sent < byte_length:
-        # pylint: disable=no-member
-        num_sent += client_s.send(bytes_obj[num_sent:])
-
-    if logger.isEnabledFor(logging.DEBUG):
-        bytes_summary = bytes(bytes_obj[:50])
-        logger.debug("Sent %d bytes of data (summary: %r%s)",
-                     num_sent,
-                     bytes_summary,
-                     '...' if byte_length > len(bytes_summary) else '')
 
-    return num_sent, byte_length, ctrl_num
+def __advise_sequential(file_obj, fsize):
+    # The file is read from start to end over and over, so ask the kernel
+    # for a larger readahead window and to start paging it in right away.
+    # See posix_fadvise(2)
+    if not hasattr(os, 'posix_fadvise'):
+        return
 
+    try:
+        os.posix_fadvise(
+            file_obj.fileno(), 0, fsize, os.POSIX_FADV_SEQUENTIAL)
+        os.posix_fadvise(
+            file_obj.fileno(), 0, fsize, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        logger.warning("Unable to advise the access pattern of the file")
 
-def __setup_env(args_ns):
-    sock = __setup_socket(args_ns.bind_addr, args_ns.port)
 
+def __prepare_file(args_ns):
     file_obj = __validate_file(args_ns.filename, args_ns.size)
     fsize = os.fstat(file_obj.fileno()).st_size
     if not fsize:
+        file_obj.close()
         raise RuntimeError("Invalid file size", fsize)
 
-    iofilter = None
-    if not args_ns.zerocopy:
-        classobj = Util.get_classobj_of(args_ns.method[0], type(file_obj))
-        iofilter = classobj.create(
-            file_obj, args_ns.bufsize, extra_args=args_ns.method[1:])
+    __advise_sequential(file_obj, fsize)
+
+    if args_ns.prefilter:
+        # The filtered file replaces the data file, which is closed along
+        # with the iofilter.
+        file_obj, fsize = __prefilter(
+            __create_iofilter(args_ns, file_obj), fsize, args_ns.bufsize)
 
     logger.info("Ready to send %d bytes using data file size of %d bytes",
                 args_ns.size, fsize)
+    return file_obj, fsize
+
+
+def __create_iofilter(args_ns, file_obj):
+    classobj = Util.get_classobj_of(args_ns.method[0], type(file_obj))
+    return classobj.create(
+        file_obj, args_ns.bufsize, extra_args=args_ns.method[1:])
+
+
+def __pin_cpu(cpu):
+    try:
+        os.sched_setaffinity(0, {cpu})
+    except OSError:
+        logger.exception("Unable to pin the server to CPU %d", cpu)
+        raise
+
+    logger.info("[CPU affinity: %r]", os.sched_getaffinity(0))
+
+
+def __setup_env(args_ns, sock, file_obj):
+    iofilter = None
+    if not (args_ns.zerocopy or args_ns.prefilter):
+        if args_ns.workers > 1:
+            # The file inherited from the parent shares the file position
+            # with the other workers, so open it again for reading.
+            inherited_obj = file_obj
+            file_obj = open(inherited_obj.name, "rb")
+            inherited_obj.close()
+
+        iofilter = __create_iofilter(args_ns, file_obj)
 
     logger.info("Listening socket bound to port %d", args_ns.port)
     try:
@@ -182,70 +385,168 @@ def __setup_env(args_ns):
 
         logger.info("Accepted incoming connection %s from client. \
 Sending data ...", client_addr)
+        __set_cork(client_s, True)
 
     except socket.error:
         logger.exception("Unable to accept()")
         sock.close()
         sock = None
         file_obj.close()
-        if not args_ns.zerocopy:
+        if iofilter is not None:
             iofilter.close()
         raise
 
-    return sock, file_obj, fsize, iofilter, client_s
+    return file_obj, iofilter, client_s
 
 
 def __do_start(args_ns):
-    logger.info("[bufsize: %d bytes] [zerocopy: %r]",
-                args_ns.bufsize, args_ns.zerocopy)
+    logger.info("[bufsize: %d bytes] [zerocopy: %r] [prefilter: %r] \
+[workers: %d]",
+                args_ns.bufsize, args_ns.zerocopy, args_ns.prefilter,
+                args_ns.workers)
 
-    sock, file_obj, fsize, iofilter, client_s = __setup_env(args_ns)
+    sock = __setup_socket(args_ns.bind_addr, args_ns.port, args_ns.sndbuf,
+                          args_ns.workers)
 
-    left = args_ns.size
+    # Prepare the data file once and share it with all the workers
+    try:
+        file_obj, fsize = __prepare_file(args_ns)
+    except Exception:
+        sock.close()
+        raise
+
+    if args_ns.workers == 1:
+        __serve(args_ns, sock, file_obj, fsize, 0)
+        return
+
+    # The workers share the listening socket and each accepts one client.
+    # Unlike separate SO_REUSEPORT sockets, the kernel hands a connection
+    # to whichever worker is waiting in accept(), so no connection can be
+    # queued on a worker that has already accepted its client.
+    workers = [Process(target=__serve,
+                       args=(args_ns, sock, file_obj, fsize, idx))
+               for idx in range(args_ns.workers)]
+    for worker in workers:
+        worker.start()
+    sock.close()
+    file_obj.close()
+
+    for worker in workers:
+        worker.join()
+        if worker.exitcode:
+            logger.error("Worker %d exited with code %d",
+                         worker.pid, worker.exitcode)
+
+
+def __sendfile_loop(client_s, file_obj, fsize, left, stats):
+    # Call os.sendfile() directly rather than socket.sendfile(), which
+    # wraps every call with its own chunking and bookkeeping. The file
+    # offset is passed explicitly and wraps around at the end of the file,
+    # so the file position is never touched.
+    out_fd = client_s.fileno()
+    in_fd = file_obj.fileno()
+    offset = 0
     total_sent = 0
-    total_read = 0
+    debug_enabled = logger.isEnabledFor(logging.DEBUG)
 
-    t_start = dt.now().timestamp()
     try:
         while left > 0:
-            if args_ns.zerocopy:
-                ctrl_num = __zerosend(left, fsize, file_obj, client_s)
-                total_sent += ctrl_num
-                total_read += ctrl_num
-            else:
-                num_sent, num_read, ctrl_num = __send(
-                    left, args_ns.bufsize, iofilter, client_s)
-                total_sent += num_sent
-                total_read += num_read
+            ctrl_num = os.sendfile(
+                out_fd, in_fd, offset, min(left, fsize - offset))
+            if not ctrl_num:
+                raise RuntimeError(
+                    "Unexpected end of data file at offset", offset)
+
+            offset += ctrl_num
+            if offset == fsize:
+                offset = 0
 
+            total_sent += ctrl_num
             left -= ctrl_num
 
+            if debug_enabled:
+                logger.debug("Sent %d bytes of data", ctrl_num)
+    finally:
+        # Keep the counters local in the loop and only publish them once
+        stats.sent = stats.read = total_sent
+
+
+def __sendall_loop(client_s, iofilter, bufsize, left, stats):
+    # Bind to local names to save the lookups in the loop
+    read = iofilter.read
+    # Unlike send(), sendall() keeps sending in C until all data has been
+    # sent or an error occurs.
+    #   https://docs.python.org/3/library/socket.html#socket.socket.sendall
+    # pylint: disable=no-member
+    sendall = client_s.sendall
+    total_sent = 0
+    debug_enabled = logger.isEnabledFor(logging.DEBUG)
+
+    try:
+        while left > 0:
+            # Only the reads at the tail of the transfer ask for less than
+            # bufsize, so keep reading the same size as long as it fits.
+            # Once left drops below it, e.g. after a short read at the end
+            # of the data file, pick the size again.
+            chunk = bufsize if left >= bufsize else left
+            while left >= chunk:
+                bytes_obj, ctrl_num = read(chunk)
+                sendall(bytes_obj)
+
+                byte_length = len(bytes_obj)
+                total_sent += byte_length
+                left -= ctrl_num
+
+                if debug_enabled:
+                    logger.debug("Sent %d bytes of data (summary: %s)",
+                                 byte_length, Util.summarize(bytes_obj))
+    finally:
+        # Keep the counters local in the loop and only publish them once
+        stats.sent = stats.read = total_sent
+
+
+def __serve(args_ns, sock, file_obj, fsize, worker_idx):
+    if args_ns.cpu is not None:
+        __pin_cpu(args_ns.cpu + worker_idx)
+
+    file_obj, iofilter, client_s = __setup_env(args_ns, sock, file_obj)
+
+    # No iofilter is needed if the file is sent as is or prefiltered
+    zerocopy = iofilter is None
+    stats = Namespace(sent=0, read=0)
+
+    # Keep collection pauses out of the timed window. Nothing allocated in
+    # the loops outlives an iteration, so there are no cycles to collect.
+    gc.disable()
+
+    t_start = time.monotonic()
+    try:
+        if zerocopy:
+            __sendfile_loop(client_s, file_obj, fsize, args_ns.size, stats)
+        else:
+            __sendall_loop(
+                client_s, iofilter, args_ns.bufsize, args_ns.size, stats)
+
     # pylint: disable=undefined-variable
     except (ConnectionResetError, BrokenPipeError):
         logger.warning("Connection closed by client")
-        if args_ns.zerocopy:
-            # File position is updated on socket.sendfile() return or also
-            # in case of error in which case file.tell() can be used to
-            # figure out the number of bytes which were sent.
-            # https://docs.python.org/3/library/socket.html#socket.socket.sendfile
-            num_sent = file_obj.tell()
-            total_sent += num_sent
-            total_read += num_sent
     except ValueError:
         logger.exception(
             "Fail to read data from buffered stream %r", file_obj.name)
     finally:
-        t_dur = dt.now().timestamp() - t_start
+        t_dur = time.monotonic() - t_start
+        gc.enable()
         __make_summary(t_dur,
-                       total_read,
-                       iofilter.get_count() if not args_ns.zerocopy else None,
-                       total_sent)
+                       stats.read,
+                       iofilter.get_count() if not zerocopy else None,
+                       stats.sent)
 
+        __set_cork(client_s, False)
         client_s.close()
         sock.close()
         sock = None
         file_obj.close()
-        if not args_ns.zerocopy:
+        if not zerocopy:
             iofilter.close()
         logger.info("Resources closed, now exiting")
 
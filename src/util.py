@@ -4,6 +4,7 @@
 from importlib import import_module
 from pkgutil import walk_packages
 
+import functools
 import inspect
 import logging
 import re
@@ -19,13 +20,20 @@ class Util(object):
     _SUPPORT_UNITS = ['b', 'kb', 'mb', 'gb']
 
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def list_methods():
-        """List all the method names in the methods folder."""
-        return [name for _, name, _ in walk_packages(methods.__path__)
-                if name != 'iofilter']
+        """List all the method names in the methods folder.
+
+        The folder is only scanned once. The names are returned as a tuple
+        since the same object is handed to every caller.
+
+        """
+        return tuple(name for _, name, _ in walk_packages(methods.__path__)
+                     if name != 'iofilter')
 
     # pylint: disable=inconsistent-return-statements
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def get_classobj_of(method, stream_type):
         """Get the class object according to the method name and stream type.
 
@@ -109,6 +117,19 @@ class Util(object):
             Util.logger,
             "Invalid input size {!r}".format(size))
 
+    @staticmethod
+    def summarize(bytes_obj, length=50):
+        """Return the repr of the leading bytes for logging.
+
+        Args:
+            bytes_obj (bytes-like): The data to summarize. It can be a
+                memoryview, which has no useful repr of its own.
+            length (int): The maximum number of bytes to show.
+
+        """
+        summary = repr(bytes(bytes_obj[:length]))
+        return summary + '...' if len(bytes_obj) > length else summary
+
     @staticmethod
     def value_err(logger, err_msg):
         """Log the error before returning the err object."""